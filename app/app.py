@@ -2,14 +2,22 @@
 # -*- coding: utf-8 -*-
 
 # Necessary API imports
-from flask import Flask, request
+from flask import Flask, request, make_response
 from functools import wraps
 from flask_restplus import Api, Resource, fields
+import hmac
+import logging
 import os
 
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
 
 # Graph modules
-from climate_scanner.entity_network.graph_demo.neo4j_model import GraphConstructor
+from climate_scanner.entity_network.graph_demo.neo4j_model import (GraphConstructor,
+	PayloadError, NodeNotFound)
 from climate_scanner.entity_network.graph_demo.entity_extraction import EntityExtractor
 from climate_scanner.sentiment_classifier.sentiment_classifier import SentimentInterface
 from climate_scanner.trends_innovation_classifier.trends_innovation_classifier import TrendsInnovationClassifier
@@ -29,9 +37,27 @@ authorizations = {
 
 api = Api(app=app, authorizations=authorizations)
 
-# Load in key from environment vars typically
-# SWAGGER_KEY = os.environ.get('SWAGGER_KEY')
-SWAGGER_KEY = '1234'
+
+# Serialize responses with orjson when it is available: annotation lists
+# are large nested structures and orjson renders them roughly an order of
+# magnitude faster than the stdlib encoder. Falls back to the default
+# Flask-RESTPlus representation when orjson is not installed.
+if orjson != None:
+	@api.representation('application/json')
+	def output_json(data, code, headers=None):
+		resp = make_response(
+			orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+			code)
+		resp.headers.extend(headers or {})
+		resp.headers['Content-Type'] = 'application/json'
+		return resp
+
+
+logger = logging.getLogger(__name__)
+
+# Load in key from environment vars, kept as bytes so the per-request
+# comparison does not re-encode it
+SWAGGER_KEY = os.environ.get('SWAGGER_KEY', '1234').encode()
 
 
 # Initialize Graph Handler and Entity Extractor Objects
@@ -44,27 +70,24 @@ trends_model = TrendsInnovationClassifier()
 ##############################################################################
 #
 #	A function wrapper for the end-point methods to provide some rudimentary
-#	security.
-#
-#	TODO: host key for security, rather than keeping in codebase
+#	security. The comparison is constant-time so the key cannot be probed
+#	via response timing, and nothing is written to stdout on the hot path.
 #
 ##############################################################################
 
 def key_required(func):
 	@wraps(func)
 	def decorated(*args, **kwargs):
-		end_key = None
-
-		if 'Authorization' in request.headers:
-			end_key = request.headers['Authorization']
+		end_key = request.headers.get('Authorization')
 
 		if not end_key:
 			return {'status': 401, 'message': 'Api Key required'}
 
-		if end_key != SWAGGER_KEY:
+		if not hmac.compare_digest(end_key.encode(), SWAGGER_KEY):
 			return {'status': 401, 'message': 'Api Key Incorrect'}
 
-		print('API Key: {}'.format(end_key))
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('API Key accepted')
 		return func(*args, **kwargs)
 
 	return decorated
@@ -98,20 +121,49 @@ name_space_3 = api.namespace('Trendscanner Master Call',
 #
 ##########################################################################################
 
+# The entity payload is shaped as three parallel arrays (names, types,
+# props) rather than a list of arbitrary 3-tuples: typed fields skip the
+# fields.Arbitrary slow path in the marshaller, and the arrays line up
+# directly with what the UNWIND batch writes want.
 graph_data = api.model('Graph Model', {
-	'entities': fields.List(required=True,
-					  description="List of incoming entities",
+	'names': fields.List(required=True,
+					  description="Entity names, parallel to types and props",
+					  example=['Chris Ballinger', 'the Future Blockchain Summit', 'Ford'],
+					  cls_or_instance=fields.String),
+
+	'types': fields.List(required=True,
+					  description="Entity identifiers, parallel to names",
+					  example=['PERSON', 'ORG', 'ORG'],
+					  cls_or_instance=fields.String),
+
+	'props': fields.List(required=False,
+					  description="Per-entity property objects, parallel to names",
 					  example=[
-						  ['Chris Ballinger', 'PERSON',
-							 {'entityType': None, 'wiki_classes': None,
-							 'url': None, 'dbPediaIri': None}],
-						  ['the Future Blockchain Summit', 'ORG',
-							 {'entityType': None, 'wiki_classes': None,
-							 'url': None, 'dbPediaIri': None}],
-						  ['Ford', 'ORG', {'entityType': ['Agent', 'Organisation', 'Company'], 'wiki_classes': ['automobile manufacturer', 'sponsor', 'car brand', 'manufacturing company', 'legal person'], 'url': 'http://en.wikipedia.org/wiki/Ford_Motor_Company', 'dbPediaIri': 'http://dbpedia.org/resource/Ford_Motor_Company'}]],
-					  cls_or_instance=fields.Arbitrary())
+						  {'entityType': None, 'wiki_classes': None,
+						  'url': None, 'dbPediaIri': None},
+						  {'entityType': None, 'wiki_classes': None,
+						  'url': None, 'dbPediaIri': None},
+						  {'entityType': ['Agent', 'Organisation', 'Company'], 'wiki_classes': ['automobile manufacturer', 'sponsor', 'car brand', 'manufacturing company', 'legal person'], 'url': 'http://en.wikipedia.org/wiki/Ford_Motor_Company', 'dbPediaIri': 'http://dbpedia.org/resource/Ford_Motor_Company'}],
+					  cls_or_instance=fields.Raw)
 })
 
+
+def payload_to_entities(data):
+	# Accepts both the parallel-array payload and the legacy
+	# {'entities': [[name, type, props], ...]} structure. The arrays must
+	# line up, otherwise zip would silently drop entities.
+	if 'entities' in data:
+		return data['entities']
+
+	names = data['names']
+	types = data['types']
+	props = data['props'] if data.get('props') != None else [None] * len(names)
+
+	if len(types) != len(names) or len(props) != len(names):
+		raise PayloadError("names, types and props must have the same length")
+
+	return [[n, t, p] for n, t, p in zip(names, types, props)]
+
 node_data = api.model('Node Model', {
 
 	'name': fields.String(
@@ -189,12 +241,9 @@ class ManageNodes(Resource):
 
 			return {'status': 200, 'nodes': results}
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 	# Defining a get rest functionality to get disambiguated location object
 	@name_space.doc(security='apikey')
@@ -210,20 +259,25 @@ class ManageNodes(Resource):
 		</p>
 		"""
 		try:
-			data = api.payload
-			success = graph.create_nodes(data['entities'])
+			entities = payload_to_entities(api.payload)
+
+			# Duplicate mentions are collapsed before crossing the Bolt
+			# boundary: deduping here is O(N), while every duplicate MERGE
+			# costs Neo4j an index seek plus a write lock.
+			names_seen = set()
+			entities = [e for e in entities
+						if not (e[0] in names_seen or names_seen.add(e[0]))]
+
+			success = graph.create_nodes(entities)
 
 			if(success):
 				return {'status': 200, 'message': 'Nodes and relationships created successfully'}
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 	@name_space.doc(security='apikey')
 	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
@@ -249,12 +303,9 @@ class ManageNodes(Resource):
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 	@name_space.doc(security='apikey')
 	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
@@ -277,12 +328,9 @@ class ManageNodes(Resource):
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 
 @name_space.route('/extraction/')
@@ -302,17 +350,13 @@ class EntityExtraction(Resource):
 		"""
 		try:
 			data = api.payload
-			print(data['text'])
 			entities = extractor.get_annotations(data['text'])
 
 			return {'status': 200, 'message': entities}
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 @name_space.route('/entity-network/')
 class EntityGraphBuild(Resource):
@@ -333,19 +377,23 @@ class EntityGraphBuild(Resource):
 		try:
 			data = api.payload
 			entities = extractor.get_annotations(data['text'])
-			success = graph.create_nodes(entities)
+
+			# NER output repeats entities mentioned more than once, so dedup
+			# by name before the graph write, as in ManageNodes.post.
+			names_seen = set()
+			deduped = [e for e in entities
+						if not (e[0] in names_seen or names_seen.add(e[0]))]
+
+			success = graph.create_nodes(deduped)
 
 			if(success):
 				return {'status': 200, 'message': entities}
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 
 @name_space_1.route('/sentiment/')
@@ -365,17 +413,13 @@ class SentimentEngine(Resource):
 		"""
 		try:
 			data = api.payload
-			print(data['text'])
 			sentiment = sentiment_model.text_to_sentiment(data['text'])
 
 			return {'status': 200, 'sentiment': sentiment}
 
-		except KeyError as e:
+		except KeyError:
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 @name_space_2.route('/trends/')
 class Trends(Resource):
@@ -394,17 +438,13 @@ class Trends(Resource):
 		"""
 		try:
 			data = api.payload
-			print(data['text'])
 			trends = trends_model.demo_return(data['text'])
 			return {'status': 200,
 					'trends': trends}
 
-		except KeyError as e:
+		except KeyError:
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 @name_space_3.route('/Master/')
 class Master(Resource):
 
@@ -423,7 +463,6 @@ class Master(Resource):
 		"""
 		try:
 			data = api.payload
-			print(data['text'])
 			trends = trends_model.demo_return(data['text'])
 			sentiment = sentiment_model.text_to_sentiment(data['text'])
 			entities = extractor.get_annotations(data['text'])
@@ -432,11 +471,17 @@ class Master(Resource):
 					'sentiment': sentiment,
 					'entities': entities}
 
-		except KeyError as e:
+		except KeyError:
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
+
+# Anything the handlers did not anticipate lands here instead of being
+# re-wrapped in a per-handler blanket except, keeping the happy path free
+# of broad exception machinery and the 4xx/5xx mapping in one place.
+@api.errorhandler
+def default_error_handler(error):
+	"""Format any uncaught error as a JSON 500 response."""
+	return {'status': 500, 'message': 'Error within app: ' + str(error)}, 500
 
 
 if __name__ == '__main__':
@@ -2,14 +2,31 @@
 # -*- coding: utf-8 -*-
 
 # Necessary API imports
-from flask import Flask, request
+from flask import Flask, request, make_response, Response, stream_with_context
 from functools import wraps
 from flask_restplus import Api, Resource, fields
+import hashlib
+import hmac
+import json
+import logging
+import os
+import uuid
+
+import redis
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
 
 
 # Graph modules
-from neo4j_model import GraphConstructor
-from entity_extraction import EntityExtractor
+from neo4j_model import GraphConstructor, PayloadError, NodeNotFound
+from entity_extraction import annotate_text, annotate_texts
 
 
 # Initialise application
@@ -26,40 +43,127 @@ authorizations = {
 
 api = Api(app=app, authorizations=authorizations)
 
-# Load in key from environment vars typically
-# SWAGGER_KEY = os.environ.get('SWAGGER_KEY')
-SWAGGER_KEY = '1234'
 
+# Serialize responses with orjson when it is available: annotation lists
+# are large nested structures and orjson renders them roughly an order of
+# magnitude faster than the stdlib encoder. Falls back to the default
+# Flask-RESTPlus representation when orjson is not installed.
+if orjson != None:
+	@api.representation('application/json')
+	def output_json(data, code, headers=None):
+		resp = make_response(
+			orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+			code)
+		resp.headers.extend(headers or {})
+		resp.headers['Content-Type'] = 'application/json'
+		return resp
+
+
+logger = logging.getLogger(__name__)
 
-# Initialize Graph Handler and Entity Extractor Objects
+# Load in key from environment vars, kept as bytes so the per-request
+# comparison does not re-encode it
+SWAGGER_KEY = os.environ.get('SWAGGER_KEY', '1234').encode()
+
+
+# Initialize Graph Handler
 graph = GraphConstructor()
-extractor = EntityExtractor()
+
+# NER is CPU-bound, so run it on a process pool rather than the Flask
+# request thread: the worker keeps serving requests while spaCy saturates
+# the cores. Each pool process lazily builds its own warm extractor.
+EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count())
+EXTRACTION_TIMEOUT = int(os.environ.get('EXTRACTION_TIMEOUT', 30))
 
 
 ##############################################################################
 #
-#	A function wrapper for the end-point methods to provide some rudimentary
-#	security.
+#	Redis cache-aside layer. Popular GET /nodes/ filters and repeat
+#	extraction payloads are answered from Redis with a short TTL instead
+#	of re-running the Cypher/spaCy pipeline. If Redis is unreachable the
+#	helpers fall through to the underlying call, so the cache is a pure
+#	optimisation.
 #
-#	TODO: host key for security, rather than keeping in codebase
+##############################################################################
+
+cache = redis.Redis(host=os.environ.get('REDIS_HOST', 'localhost'),
+					port=int(os.environ.get('REDIS_PORT', 6379)),
+					socket_connect_timeout=1, socket_timeout=1)
+
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+
+cache_stats = {'hits': 0, 'misses': 0}
+
+
+def cache_get(key):
+	try:
+		blob = cache.get(key)
+	except Exception as e:
+		logger.warning(str(e))
+		return None
+
+	if blob != None:
+		cache_stats['hits'] += 1
+		return json.loads(blob)
+
+	cache_stats['misses'] += 1
+	return None
+
+
+def cache_set(key, value):
+	try:
+		cache.setex(key, CACHE_TTL, json.dumps(value))
+	except Exception as e:
+		logger.warning(str(e))
+
+
+# Invalidation of the node listings lives in the graph layer (every
+# successful create/update/delete bumps the shared version and drops the
+# nodes:* keys), so writes from any app going through GraphConstructor
+# keep this cache honest.
+
+# Distinguishes this process's in-memory version counter across restarts.
+# It is mixed into the ETag whenever the shared counter is unavailable, so
+# a stale ETag can only produce a cache miss, never a false 304.
+BOOT_NONCE = uuid.uuid4().hex[:8]
+
+
+def current_graph_version():
+	# The Redis counter is shared by all workers, so a write handled by
+	# one worker invalidates the ETags served by the others. Without it,
+	# each worker's per-process counter could confirm a stale ETag for
+	# data another worker had already changed.
+	try:
+		version = cache.get('graph:version')
+		if version != None:
+			return version.decode()
+	except Exception as e:
+		logger.warning(str(e))
+
+	return '{}-{}'.format(BOOT_NONCE, graph.version)
+
+
+##############################################################################
+#
+#	A function wrapper for the end-point methods to provide some rudimentary
+#	security. The comparison is constant-time so the key cannot be probed
+#	via response timing, and nothing is written to stdout on the hot path.
 #
 ##############################################################################
 
 def key_required(func):
 	@wraps(func)
 	def decorated(*args, **kwargs):
-		end_key = None
-
-		if 'Authorization' in request.headers:
-			end_key = request.headers['Authorization']
+		end_key = request.headers.get('Authorization')
 
 		if not end_key:
 			return {'status': 401, 'message': 'Api Key required'}
 
-		if end_key != SWAGGER_KEY:
+		if not hmac.compare_digest(end_key.encode(), SWAGGER_KEY):
 			return {'status': 401, 'message': 'Api Key Incorrect'}
 
-		print('API Key: {}'.format(end_key))
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('API Key accepted')
 		return func(*args, **kwargs)
 
 	return decorated
@@ -81,20 +185,49 @@ name_space = api.namespace('TrendScanner Graph API',
 #
 ##########################################################################################
 
+# The entity payload is shaped as three parallel arrays (names, types,
+# props) rather than a list of arbitrary 3-tuples: typed fields skip the
+# fields.Arbitrary slow path in the marshaller, and the arrays line up
+# directly with what the UNWIND batch writes want.
 graph_data = api.model('Graph Model', {
-	'entities': fields.List(required=True,
-					  description="List of incoming entities",
+	'names': fields.List(required=True,
+					  description="Entity names, parallel to types and props",
+					  example=['Chris Ballinger', 'the Future Blockchain Summit', 'Ford'],
+					  cls_or_instance=fields.String),
+
+	'types': fields.List(required=True,
+					  description="Entity identifiers, parallel to names",
+					  example=['PERSON', 'ORG', 'ORG'],
+					  cls_or_instance=fields.String),
+
+	'props': fields.List(required=False,
+					  description="Per-entity property objects, parallel to names",
 					  example=[
-						  ['Chris Ballinger', 'PERSON',
-							 {'entityType': None, 'wiki_classes': None,
-							 'url': None, 'dbPediaIri': None}],
-						  ['the Future Blockchain Summit', 'ORG',
-							 {'entityType': None, 'wiki_classes': None,
-							 'url': None, 'dbPediaIri': None}],
-						  ['Ford', 'ORG', {'entityType': ['Agent', 'Organisation', 'Company'], 'wiki_classes': ['automobile manufacturer', 'sponsor', 'car brand', 'manufacturing company', 'legal person'], 'url': 'http://en.wikipedia.org/wiki/Ford_Motor_Company', 'dbPediaIri': 'http://dbpedia.org/resource/Ford_Motor_Company'}]],
-					  cls_or_instance=fields.Arbitrary())
+						  {'entityType': None, 'wiki_classes': None,
+						  'url': None, 'dbPediaIri': None},
+						  {'entityType': None, 'wiki_classes': None,
+						  'url': None, 'dbPediaIri': None},
+						  {'entityType': ['Agent', 'Organisation', 'Company'], 'wiki_classes': ['automobile manufacturer', 'sponsor', 'car brand', 'manufacturing company', 'legal person'], 'url': 'http://en.wikipedia.org/wiki/Ford_Motor_Company', 'dbPediaIri': 'http://dbpedia.org/resource/Ford_Motor_Company'}],
+					  cls_or_instance=fields.Raw)
 })
 
+
+def payload_to_entities(data):
+	# Accepts both the parallel-array payload and the legacy
+	# {'entities': [[name, type, props], ...]} structure. The arrays must
+	# line up, otherwise zip would silently drop entities.
+	if 'entities' in data:
+		return data['entities']
+
+	names = data['names']
+	types = data['types']
+	props = data['props'] if data.get('props') != None else [None] * len(names)
+
+	if len(types) != len(names) or len(props) != len(names):
+		raise PayloadError("names, types and props must have the same length")
+
+	return [[n, t, p] for n, t, p in zip(names, types, props)]
+
 node_data = api.model('Node Model', {
 
 	'name': fields.String(
@@ -148,28 +281,65 @@ class ManageNodes(Resource):
 
 	@name_space.doc(security='apikey')
 	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
-			  params={'entityType': 'Specify the entity type to filter the resulting nodes. Common entity types are PERSON, ORG, GPE. Leave empty for retrieving all the nodes'})
+			  params={'entityType': 'Specify the entity type to filter the resulting nodes. Common entity types are PERSON, ORG, GPE. Leave empty for retrieving all the nodes',
+					  'stream': 'Set to 1 to stream the nodes as newline-delimited JSON instead of one buffered list',
+					  'page': 'Page number for classic pagination, starting at 1. Used together with limit',
+					  'limit': 'Maximum number of nodes per page'})
 	@key_required
 	def get(self):
 		"""Get nodes by entity type
 		<strong>Implementation Notes</strong>.
 		<p>
 		Get a list of nodes with all the associated properties. It is possible to filter
-		by entity type.
+		by entity type. Large result sets can be streamed as newline-delimited
+		JSON with stream=1, or paged with the page and limit params.
 		</p>
 		"""
 		try:
 
 			entity_type = request.args.get('entityType')
-			results = graph.get_nodes(entity_type)
 
-			return {'status': 200, 'nodes': results}
+			# Streaming sends each node as one NDJSON line straight off the
+			# Bolt cursor, so neither the server nor the client has to hold
+			# the full result list in memory.
+			if request.args.get('stream') == '1':
+				def generate():
+					for node in graph.iter_nodes(entity_type):
+						yield json.dumps(node) + '\n'
 
-		except KeyError as e:
-			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
+				return Response(stream_with_context(generate()),
+								mimetype='application/x-ndjson')
+
+			limit = request.args.get('limit', type=int)
+			page = request.args.get('page', type=int)
+
+			# A negative $skip or $limit is rejected by Neo4j at runtime, so
+			# refuse bad paging input here with a 400 instead.
+			if (page != None and page < 1) or (limit != None and limit < 0):
+				raise PayloadError("page must be >= 1 and limit must be >= 0")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
+			skip = (page - 1) * limit if (page != None and limit != None) else 0
+
+			page_key = 'nodes:{}:{}:{}'.format(
+				entity_type if entity_type != None else 'all', skip, limit)
+
+			# The graph version is bumped by every successful write, so a
+			# matching ETag means the client's copy is still current and the
+			# query, marshaling and payload can all be skipped.
+			etag = 'W/"{}-{}"'.format(current_graph_version(), page_key)
+			if request.headers.get('If-None-Match') == etag:
+				return None, 304, {'ETag': etag}
+
+			results = cache_get(page_key)
+
+			if results == None:
+				results = graph.get_nodes(entity_type, skip, limit)
+				cache_set(page_key, results)
+
+			return {'status': 200, 'nodes': results}, 200, {'ETag': etag}
+
+		except (KeyError, PayloadError, NodeNotFound):
+			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
 
 	# Defining a get rest functionality to get disambiguated location object
@@ -186,20 +356,28 @@ class ManageNodes(Resource):
 		</p>
 		"""
 		try:
-			data = api.payload
-			success = graph.create_nodes(data['entities'])
+			entities = payload_to_entities(api.payload)
+
+			# Duplicate mentions are collapsed before crossing the Bolt
+			# boundary: deduping here is O(N), while every duplicate MERGE
+			# costs Neo4j an index seek plus a write lock.
+			names_seen = set()
+			entities = [e for e in entities
+						if not (e[0] in names_seen or names_seen.add(e[0]))]
+
+			# The fully-connected edge set is spelled out client-side so the
+			# write is an UNWIND over explicit pairs, never a Cartesian MATCH.
+			pairs = {tuple(sorted((a[0], b[0]))) for a, b in combinations(entities, 2)}
+			success = graph.create_nodes(entities, list(pairs))
 
 			if(success):
 				return {'status': 200, 'message': 'Nodes and relationships created successfully'}
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 	@name_space.doc(security='apikey')
 	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
@@ -225,12 +403,9 @@ class ManageNodes(Resource):
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 	@name_space.doc(security='apikey')
 	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
@@ -253,12 +428,9 @@ class ManageNodes(Resource):
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
-
 
 
 @name_space.route('/extraction/')
@@ -278,16 +450,90 @@ class EntityExtraction(Resource):
 		"""
 		try:
 			data = api.payload
-			print(data['text'])
-			entities = extractor.get_annotations(data['text'])
+
+			# Extraction is deterministic and CPU-heavy, so key the cache on
+			# a hash of the payload text rather than the text itself.
+			# ?nocache=1 busts both cache layers and refreshes the entry.
+			nocache = request.args.get('nocache') == '1'
+			cache_key = 'extract:' + hashlib.sha1(data['text'].encode()).hexdigest()
+			entities = None if nocache else cache_get(cache_key)
+
+			if entities == None:
+				entities = EXECUTOR.submit(annotate_text, data['text'], nocache).result(timeout=EXTRACTION_TIMEOUT)
+				cache_set(cache_key, entities)
 
 			return {'status': 200, 'message': entities}
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
+			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
+
+
+texts_data = api.model('Batch Text Model', {
+	'texts': fields.List(required=True,
+					description="Texts for processing in one batch",
+					example=['Sir Keir Starmer has urged the government to invest urgently in green jobs.',
+							'Ford received a patent to use blockchain technology on the road.'],
+					cls_or_instance=fields.String)
+})
+
+
+@name_space.route('/extraction/batch/')
+class BatchExtraction(Resource):
+
+	@name_space.doc(security='apikey')
+	@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 500: 'Internal Server Error'},
+			  params={'n_process': 'Number of spaCy worker processes for the batch. Defaults to 1.'})
+	@api.expect(texts_data, validate=False)
+	@key_required
+	def post(self):
+		"""Extract entities from many texts in one pass
+		<strong>Implementation Notes</strong>.
+		<p>
+		Send a list of texts in the body. All the texts are annotated in a
+		single spaCy pipe pass, which is much faster than one request per
+		text. The entity lists are returned in input order.
+		</p>
+		"""
+		try:
+			data = api.payload
+
+			# n_process comes straight off the querystring, so reject
+			# non-integers as a 400 and cap it at the core count rather
+			# than forking however many processes the caller asked for.
+			try:
+				n_process = int(request.args.get('n_process', 1))
+			except ValueError:
+				raise PayloadError("n_process must be an integer")
+
+			n_process = max(1, min(n_process, os.cpu_count()))
+
+			results = EXECUTOR.submit(annotate_texts, data['texts'], 64, n_process)\
+						.result(timeout=EXTRACTION_TIMEOUT * max(len(data['texts']), 1))
+
+			return {'status': 200, 'results': results}
+
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
+
+@name_space.route('/meta/cache-stats/')
+class CacheStats(Resource):
+
+	@name_space.doc(security='apikey')
+	@api.doc(responses={200: 'OK', 500: 'Internal Server Error'})
+	@key_required
+	def get(self):
+		"""Report cache hit/miss counters
+		<strong>Implementation Notes</strong>.
+		<p>
+		Returns the hit and miss counts of the Redis cache-aside layer,
+		so the hit rate can be tracked over time.
+		</p>
+		"""
+		total = cache_stats['hits'] + cache_stats['misses']
+		hit_rate = cache_stats['hits'] / total if total else 0.0
+		return {'status': 200, 'hits': cache_stats['hits'],
+				'misses': cache_stats['misses'], 'hit_rate': hit_rate}
 
 
 @name_space.route('/entity-network/')
@@ -308,23 +554,37 @@ class EntityGraphBuild(Resource):
 		"""
 		try:
 			data = api.payload
-			entities = extractor.get_annotations(data['text'])
-			success = graph.create_nodes(entities)
+			entities = EXECUTOR.submit(annotate_text, data['text']).result(timeout=EXTRACTION_TIMEOUT)
+
+			# NER output repeats entities mentioned more than once, so dedup
+			# by name before the graph write, as in ManageNodes.post.
+			names_seen = set()
+			deduped = [e for e in entities
+						if not (e[0] in names_seen or names_seen.add(e[0]))]
+
+			pairs = {tuple(sorted((a[0], b[0]))) for a, b in combinations(deduped, 2)}
+			success = graph.create_nodes(deduped, list(pairs))
 
 			if(success):
 				return {'status': 200, 'message': entities}
 			else:
 				name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except KeyError as e:
+		except (KeyError, PayloadError, NodeNotFound):
 			name_space.abort(400,  status="Could not retrieve necessary payload information", statusCode="400")
 
-		except Exception as e:
-			name_space.abort(500,  status="Error within app: " + str(e), statusCode="500")
 
 
 
 
+# Anything the handlers did not anticipate lands here instead of being
+# re-wrapped in a per-handler blanket except, keeping the happy path free
+# of broad exception machinery and the 4xx/5xx mapping in one place.
+@api.errorhandler
+def default_error_handler(error):
+	"""Format any uncaught error as a JSON 500 response."""
+	return {'status': 500, 'message': 'Error within app: ' + str(error)}, 500
+
 
 if __name__ == '__main__':
 	app.run(port=8080, host='0.0.0.0')
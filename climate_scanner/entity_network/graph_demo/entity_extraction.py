@@ -5,6 +5,8 @@ import requests
 import os
 import spacy
 import dotenv
+from collections import OrderedDict
+from hashlib import blake2b
 dotenv.load_dotenv()
 
 user_key = os.environ.get('TRENDSCANNER_ENTITY_EXTRACTION_KEY')
@@ -214,6 +216,94 @@ class EntityExtractor:
                 ent.append({'entityType':None,'wiki_classes':None,'url':None,'dbPediaIri':None})
         return entities_list
 
+    def get_annotations_batch(self,texts,batch_size=64,n_process=1):
+        """
+        Method to extract annotations for many texts in one spaCy pass.
+        nlp.pipe shares tokenizer state and batches the POS/NER work
+        across documents, which is considerably faster than calling
+        get_annotations per text.
+
+		Args:
+            texts - list(str)
+            the texts to annotate
+
+            batch_size - (int)
+            number of documents spaCy buffers per batch
+
+            n_process - (int)
+            number of spaCy worker processes; >1 parallelizes the
+            CPU-bound NER across cores
+
+		Returns:
+            list() of per-text annotation lists, each in the same shape
+            as get_annotations()
+
+        """
+
+        results = []
+        for txt in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+            entities_list = self.get_annotations_spacy(txt)
+            if not entities_list:
+                results.append(entities_list)
+                continue
+            temp_txt = " ".join([ent[0] for ent in entities_list])
+            _,wiki_res = self.get_annotations_wiki(extraction_string=temp_txt)
+            for ent in entities_list:
+                if ent[0] in wiki_res:
+                    ent.append(wiki_res[ent[0]])
+                else:
+                    ent.append({'entityType':None,'wiki_classes':None,'url':None,'dbPediaIri':None})
+            results.append(entities_list)
+        return results
+
+
+#############################################################################
+#
+# Module-level entry point used by worker processes. The spaCy model is
+# loaded at import time, so forked workers inherit it warm; each worker
+# keeps one extractor instead of building one per call.
+#
+#############################################################################
+
+_worker_extractor = None
+
+# Extraction is deterministic, so repeat payloads are answered from a
+# small per-process LRU instead of re-running the tokenizer/NER passes.
+# Keys are fixed-size digests of the text since raw articles can be large.
+_annotation_cache = OrderedDict()
+ANNOTATION_CACHE_SIZE = int(os.environ.get('ANNOTATION_CACHE_SIZE', 1024))
+
+
+def annotate_text(doc, nocache=False):
+    global _worker_extractor
+    if _worker_extractor is None:
+        _worker_extractor = EntityExtractor()
+
+    key = blake2b(doc.encode(), digest_size=16).digest()
+
+    if not nocache:
+        cached = _annotation_cache.get(key)
+        if cached is not None:
+            _annotation_cache.move_to_end(key)
+            return cached
+
+    result = _worker_extractor.get_annotations(doc)
+
+    _annotation_cache[key] = result
+    _annotation_cache.move_to_end(key)
+    while len(_annotation_cache) > ANNOTATION_CACHE_SIZE:
+        _annotation_cache.popitem(last=False)
+
+    return result
+
+
+def annotate_texts(texts, batch_size=64, n_process=1):
+    global _worker_extractor
+    if _worker_extractor is None:
+        _worker_extractor = EntityExtractor()
+    return _worker_extractor.get_annotations_batch(texts, batch_size=batch_size,
+                                                   n_process=n_process)
+
 
 def test_code():
 	x = EntityExtractor()
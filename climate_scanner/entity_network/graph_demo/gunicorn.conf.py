@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Gunicorn configuration for the graph demo API.
+#
+# The handlers spend most of their time waiting on Bolt round-trips to
+# Neo4j, so the endpoints are served by gevent workers: hundreds of
+# greenlets per process multiplex over the shared Neo4j driver pool
+# while the CPU-bound extraction work stays on the process pool.
+# Gunicorn's gevent worker monkey-patches the stdlib before the app is
+# imported, so no explicit patching is needed here. Set
+# WEB_WORKER_CLASS=gthread to fall back to threaded workers where
+# gevent is not installed. Run with:
+#
+#	gunicorn -c gunicorn.conf.py wsgi:app
+
+import os
+
+bind = "0.0.0.0:8080"
+workers = int(os.environ.get("WEB_WORKERS", 2))
+worker_class = os.environ.get("WEB_WORKER_CLASS", "gevent")
+worker_connections = int(os.environ.get("WEB_CONNECTIONS", 500))
+threads = int(os.environ.get("WEB_THREADS", 8))
+timeout = 60
+
+# Size the Neo4j driver pool to the per-worker concurrency unless the
+# operator pinned it, so greenlets are not serialized waiting for a
+# connection.
+os.environ.setdefault("NEO4J_POOL", str(worker_connections))
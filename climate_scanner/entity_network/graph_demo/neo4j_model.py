@@ -7,10 +7,27 @@ Created on Wed Apr  6 11:36:48 2022
 """
 
 import os
-from neomodel import (config, StructuredNode, StringProperty,
+import atexit
+import logging
+from itertools import combinations
+from neomodel import (config, db, StructuredNode, StringProperty,
                       Relationship, ZeroOrMore,
                       StructuredRel, AliasProperty, UniqueIdProperty)
 
+try:
+	from pybloom_live import ScalableBloomFilter
+except ImportError:
+	# a plain set gives the same membership answers, just without the
+	# bounded-memory guarantee of the bloom filter
+	ScalableBloomFilter = None
+
+try:
+	import redis
+except ImportError:
+	redis = None
+
+logger = logging.getLogger(__name__)
+
 import dotenv
 dotenv.load_dotenv()
 db_name = os.environ.get('TRENDSCANNER_GRAPH_DB_NAME')
@@ -20,6 +37,132 @@ db_host = os.environ.get('TRENDSCANNER_GRAPH_NEO4J_HOST')
 url = "bolt://" + db_name + ":" + db_password + "@" + db_host + ":7687"
 config.DATABASE_URL = url
 
+# Driver pool tuning. neomodel keeps a single module-level driver, so all
+# handlers multiplex over one warm pool instead of paying a TCP/Bolt
+# handshake per request. The pool size is env-tunable so operators can
+# match it to the number of concurrent workers without a code change.
+config.MAX_CONNECTION_POOL_SIZE = int(os.environ.get('NEO4J_POOL', 100))
+config.MAX_CONNECTION_LIFETIME = 3600
+config.CONNECTION_ACQUISITION_TIMEOUT = 60
+
+
+def _close_driver():
+	driver = getattr(db, 'driver', None)
+	if driver != None:
+		driver.close()
+
+atexit.register(_close_driver)
+
+# Upper bound on operations per write statement. A single POST can carry
+# thousands of entities and millions of pairwise edges; committing them in
+# one transaction can exceed the server's transaction memory and abort the
+# whole insert, so large payloads are split into sized batches.
+BATCH_SIZE = int(os.environ.get('NEO4J_BATCH_SIZE', 5000))
+
+
+def _chunked(items, size):
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+# Cache invalidation lives in the graph layer because more than one app
+# writes through this module: bumping the shared version and dropping the
+# cached listings only from one app's handlers would leave the others
+# serving stale pages (and confirming stale ETags) until the TTL expired.
+if redis != None:
+	_cache = redis.Redis(host=os.environ.get('REDIS_HOST', 'localhost'),
+				port=int(os.environ.get('REDIS_PORT', 6379)),
+				socket_connect_timeout=1, socket_timeout=1)
+else:
+	_cache = None
+
+
+def _invalidate_node_caches():
+	# Bumps the shared graph version the /nodes/ ETags derive from and
+	# drops the cached node listings. Failures are logged and swallowed:
+	# the write itself already succeeded and the cache is an optimisation.
+	if _cache == None:
+		return
+	try:
+		_cache.incr('graph:version')
+		keys = list(_cache.scan_iter('nodes:*'))
+		if keys:
+			_cache.delete(*keys)
+	except Exception as e:
+		logger.warning(str(e))
+
+
+# The per-request Cypher, compiled to constants once at import. Every call
+# ships byte-identical query text with only the parameters varying, so the
+# server's plan cache always hits and no query strings are rebuilt per call.
+
+_Q_GET_NODES = (
+	"MATCH (n:Node) "
+	"WHERE $t IS NULL OR n.entity = $t "
+	"RETURN n{.uid, .name, .entity, .entity_type, "
+	".wiki_classes, .url, .dbpedia_uri}")
+
+# Pagination orders by name (the unique, indexed MERGE key) so pages are
+# cut from one deterministic ordering; without it SKIP/LIMIT could repeat
+# or drop rows between pages.
+_Q_GET_NODES_SKIP = _Q_GET_NODES + " ORDER BY n.name SKIP $skip"
+
+_Q_GET_NODES_PAGE = _Q_GET_NODES + " ORDER BY n.name SKIP $skip LIMIT $limit"
+
+_Q_UPDATE_NODE = (
+	"MATCH (n:Node {uid: $uid}) "
+	"SET n += $props "
+	"RETURN count(n)")
+
+_Q_DELETE_NODE = (
+	"MATCH (n:Node {uid: $uid}) "
+	"DETACH DELETE n")
+
+_Q_MERGE_ENTITIES = (
+	"UNWIND $entities AS e "
+	"MERGE (n:Node {name: e.name}) "
+	"SET n.uid = coalesce(n.uid, randomUUID()), "
+	"n.entity = e.entity, n.entity_type = e.entity_type, "
+	"n.wiki_classes = e.wiki_classes, n.url = e.url, "
+	"n.dbpedia_uri = e.dbpedia_uri")
+
+_Q_SET_ENTITIES = (
+	"UNWIND $entities AS e "
+	"MATCH (n:Node {name: e.name}) "
+	"SET n.entity = e.entity, n.entity_type = e.entity_type, "
+	"n.wiki_classes = e.wiki_classes, n.url = e.url, "
+	"n.dbpedia_uri = e.dbpedia_uri "
+	"RETURN e.name")
+
+_Q_MERGE_PAIRS = (
+	"UNWIND $pairs AS p "
+	"MATCH (a:Node {name: p.s}), (b:Node {name: p.t}) "
+	"MERGE (a)-[r:RELATED_TO]->(b) "
+	"SET r.rel = 'related'")
+
+_Q_MERGE_PAIRS_BATCHED = (
+	"UNWIND $pairs AS p "
+	"CALL { WITH p "
+	"MATCH (a:Node {name: p.s}), (b:Node {name: p.t}) "
+	"MERGE (a)-[r:RELATED_TO]->(b) "
+	"SET r.rel = 'related' ")
+
+_Q_GET_NAMES = "MATCH (n:Node) RETURN n.name"
+
+_Q_SERVER_VERSION = "CALL dbms.components() YIELD versions RETURN versions[0]"
+
+
+class GraphError(Exception):
+	"""Base class for errors raised by the graph layer."""
+
+
+class PayloadError(GraphError):
+	"""The request payload was missing or malformed."""
+
+
+class NodeNotFound(GraphError):
+	"""No node exists for the given identifier."""
+
 
 class BasicRel(StructuredRel):
 	rel = StringProperty(required=True)
@@ -55,103 +198,205 @@ class GraphConstructor:
 	def __init__(self):
 		self.nodes = []
 		#self.create_nodes(entities)
+		# Monotonic version stamp, bumped by every successful write. Cheap
+		# to read, so the API can answer conditional GETs without querying.
+		self.version = 0
+		self._ensure_schema()
+		self._known_names = self._build_name_filter()
+
+	def _build_name_filter(self):
+		# Approximate membership of entity names already in the graph, used
+		# by create_nodes to route existing entities onto a cheap MATCH+SET
+		# path instead of a write-locking MERGE. Warmed once at startup from
+		# the stored names.
+		if ScalableBloomFilter != None:
+			known = ScalableBloomFilter(initial_capacity=100000, error_rate=0.01)
+		else:
+			known = set()
 
-	def define_rels(self):
-		pass
-
-	def get_nodes(self,entity_type=None):
-		#TODO: Avoid returning the arrays as strings
-
-		nodes = None
 		try:
-			if(entity_type != None):
-				# Return set of nodes
-				result_nodes = Node.nodes.filter(entity=entity_type)
-			else:
-				result_nodes = Node.nodes.all()
+			results, _ = db.cypher_query(_Q_GET_NAMES)
+			for row in results:
+				if row[0] != None:
+					known.add(row[0])
+		except Exception as e:
+			print(str(e))
 
-			nodes = [n.serialize for n in result_nodes]
+		return known
 
+	def _ensure_schema(self):
+		# Every lookup path the handlers hit gets an index before the first
+		# request is served: name for the batched MERGEs in create_nodes,
+		# uid for update/delete, entity for the get_nodes filter. Without
+		# these each PUT/DELETE is a full label scan.
+		try:
+			db.cypher_query("CREATE INDEX node_name IF NOT EXISTS FOR (n:Node) ON (n.name)")
+			db.cypher_query("CREATE INDEX node_entity IF NOT EXISTS FOR (n:Node) ON (n.entity)")
+			try:
+				db.cypher_query(
+					"CREATE CONSTRAINT node_uid IF NOT EXISTS FOR (n:Node) REQUIRE n.uid IS UNIQUE")
+			except Exception:
+				# Neo4j < 4.4 only understands the ASSERT spelling
+				db.cypher_query(
+					"CREATE CONSTRAINT node_uid IF NOT EXISTS ON (n:Node) ASSERT n.uid IS UNIQUE")
 		except Exception as e:
 			print(str(e))
 
-		print(nodes)
-		return nodes
+	def _server_version(self):
+		# Cached (major, minor) of the Neo4j server, used to pick the best
+		# available batching syntax for the edge writes.
+		if getattr(self, '_version', None) == None:
+			try:
+				results, _ = db.cypher_query(_Q_SERVER_VERSION)
+				parts = results[0][0].split('.')
+				self._version = (int(parts[0]), int(parts[1]) if len(parts) > 1 else 0)
+			except Exception as e:
+				print(str(e))
+				self._version = (0, 0)
+		return self._version
 
+	def define_rels(self):
+		pass
 
-	def create_nodes(self, entities):
+	def get_nodes(self,entity_type=None,skip=0,limit=None):
+		#TODO: Avoid returning the arrays as strings
 
-		success = False
-		try:
-			for ann in entities:
-				new_node = Node(
-					name = ann[0] if ann[0]!= None else "",
-					entity = ann[1] if ann[1]!= None else "",
-					entity_type = ann[2]['entityType'] if ann[2]['entityType']!= None else [],
-					wiki_classes = ann[2]['wiki_classes'] if ann[2]['wiki_classes']!= None else [],
-					url = ann[2]['url'] if ann[2]['url']!= None else "",
-					dbpedia_uri = ann[2]['dbPediaIri'] if ann[2]['dbPediaIri']!= None else ""
-					   ).save()
+		# The filter value travels as a Bolt parameter, so every request
+		# shares one query signature in the server's plan cache and the
+		# public entityType querystring can never be spliced into Cypher.
+		# Driver errors propagate to the API's central error handler.
+		if limit != None:
+			results, _ = db.cypher_query(_Q_GET_NODES_PAGE,
+							{'t': entity_type, 'skip': skip, 'limit': limit})
+		else:
+			results, _ = db.cypher_query(_Q_GET_NODES_SKIP,
+							{'t': entity_type, 'skip': skip})
+
+		return [row[0] for row in results]
+
+	def iter_nodes(self,entity_type=None):
+		# Streaming variant of get_nodes: records are yielded one at a time
+		# straight off the Bolt cursor, so server memory stays bounded no
+		# matter how large the result set is.
+		with db.driver.session() as session:
+			for record in session.run(_Q_GET_NODES, t=entity_type):
+				yield record[0]
+
+
+	def create_nodes(self, entities, pairs=None):
+		# Instead of saving one node at a time and connecting each new node to
+		# the previous ones (one Bolt round-trip per node/edge), marshal the
+		# whole payload into parameter lists and issue two batched UNWIND
+		# statements: one merging all the nodes, one merging all the pairwise
+		# relationships. The server iterates the lists without further
+		# network chatter. Callers may pass an explicit list of (source,
+		# target) name tuples; by default every pair of entities in the
+		# payload is connected.
+
+		if not entities:
+			raise PayloadError("No entities supplied")
+
+		batch = []
+		for ann in entities:
+			props = ann[2] if ann[2] != None else {}
+			batch.append({
+				'name': ann[0] if ann[0] != None else "",
+				'entity': ann[1] if ann[1] != None else "",
+				'entity_type': props.get('entityType') if props.get('entityType') != None else [],
+				'wiki_classes': props.get('wiki_classes') if props.get('wiki_classes') != None else [],
+				'url': props.get('url') if props.get('url') != None else "",
+				'dbpedia_uri': props.get('dbPediaIri') if props.get('dbPediaIri') != None else "",
+			})
+
+		if pairs == None:
+			pairs = [(a['name'], b['name']) for a, b in combinations(batch, 2)]
+
+		# Pre-sort each pair so the smaller endpoint is always the source.
+		# With concurrent batches this gives every transaction the same
+		# lock acquisition order on shared endpoints, avoiding deadlocks.
+		# Pairs with identical endpoints (duplicate mentions that MERGE to
+		# one node) are dropped so no self-loops get written.
+		pairs = [{'s': min(s, t), 't': max(s, t)} for s, t in pairs if s != t]
+
+		# Entities whose names are already in the filter take a plain
+		# MATCH+SET, skipping MERGE's write-lock and create machinery.
+		# Filter false positives come back unmatched from the MATCH and
+		# are re-routed onto the MERGE path, so they are still created.
+		likely_new = []
+		likely_existing = []
+		for e in batch:
+			if e['name'] in self._known_names:
+				likely_existing.append(e)
+			else:
+				likely_new.append(e)
 
-				for node in self.nodes:
-					new_node.related_to.connect(node,{'rel':'related'})
+		for chunk in _chunked(likely_existing, BATCH_SIZE):
+			results, _ = db.cypher_query(_Q_SET_ENTITIES, {'entities': chunk})
 
-				self.nodes.append(new_node)
+			matched = set(row[0] for row in results)
+			likely_new.extend([e for e in chunk if e['name'] not in matched])
 
-			success = True
+		for chunk in _chunked(likely_new, BATCH_SIZE):
+			db.cypher_query(_Q_MERGE_ENTITIES, {'entities': chunk})
 
-		except Exception as e:
-			print(str(e))
+		for e in batch:
+			self._known_names.add(e['name'])
 
-		return success
+		if pairs:
+			# Neo4j 5.21+ can run the batches on multiple server threads;
+			# 4.4+ still batches server-side but serially; anything older
+			# falls back to the single UNWIND statement.
+			version = self._server_version()
+			if version >= (5, 21):
+				batching = "} IN CONCURRENT TRANSACTIONS OF 500 ROWS"
+			elif version >= (4, 4):
+				batching = "} IN TRANSACTIONS OF 500 ROWS"
+			else:
+				batching = None
 
-	def update_node(self, uid, data):
+			if batching != None:
+				db.cypher_query(_Q_MERGE_PAIRS_BATCHED + batching,
+					{'pairs': pairs})
+			else:
+				# No server-side batching available, so keep each
+				# statement's transaction to a bounded size client-side.
+				for chunk in _chunked(pairs, BATCH_SIZE):
+					db.cypher_query(_Q_MERGE_PAIRS, {'pairs': chunk})
 
-		success = False
-		if(uid == None):
-			return success
+		self.version += 1
+		_invalidate_node_caches()
 
-		try:
-			#TODO: Find a more practical way to update, maybe a loop iterating over the keys
-			node = Node.nodes.get_or_none(uid=uid)
+		return True
 
-			if(node != None):
-				node.name = data['name'] if 'name' in data else node.name
-				node.entity = data['entity'] if 'entity' in data else node.entity
-				node.entity_type = data['entity_type'] if 'entity_type' in data else node.entity_type
-				node.wiki_classes = data['wiki_classes'] if 'wiki_classes' in data else node.wiki_classes
-				node.url = data['url'] if 'url' in data else node.url
-				node.dbpedia_uri = data['dbpedia_uri'] if 'dbpedia_uri' in data else node.dbpedia_uri
-				node.save()
+	def update_node(self, uid, data):
 
-				success = True
+		if(uid == None):
+			raise PayloadError("No uid supplied")
 
-			else:
-				# Node doesn't exist
-				#TODO: Throw an exception here
-				success = False
+		# Only the known node fields are forwarded, then applied in one
+		# parameterized SET instead of a read-modify-write per property.
+		props = {k: data[k] for k in ('name', 'entity', 'entity_type',
+						'wiki_classes', 'url', 'dbpedia_uri') if k in data}
 
-		except Exception as e:
-			print(str(e))
+		results, _ = db.cypher_query(_Q_UPDATE_NODE,
+						{'uid': uid, 'props': props})
+
+		if(results[0][0] == 0):
+			raise NodeNotFound("No node with uid " + str(uid))
 
-		return success
+		self.version += 1
+		_invalidate_node_caches()
+		return True
 
 	def delete_node(self, uid):
-		success = False
 		if(uid == None):
-			return success
-
-		try:
-			node = Node.nodes.get_or_none(uid=uid)
-			if(node != None):
-				node.delete()
+			raise PayloadError("No uid supplied")
 
-			success = True
-
-		except Exception as e:
-			print(str(e))
+		db.cypher_query(_Q_DELETE_NODE, {'uid': uid})
 
-		return success
+		self.version += 1
+		_invalidate_node_caches()
+		return True
 
 
 
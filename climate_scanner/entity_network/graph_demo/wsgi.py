@@ -4,5 +4,7 @@ from app import app
 
 if __name__ == "__main__":
 
-	app.run(port=8080)
+	# threaded so the dev server also overlaps Neo4j I/O; production runs
+	# under gunicorn with the gevent config in gunicorn.conf.py
+	app.run(port=8080, threaded=True)
 
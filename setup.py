@@ -39,7 +39,7 @@ setuptools.setup(
                     "keras", "tensorflow", "pytest", "pyyaml", "torch",
                       "transformers", "Flask==1.1.4", "Flask-RESTful==0.3.9", "flask-restful-swagger==0.20.2",
                       "flask-restplus==0.13.0", "gunicorn==20.1.0", "neomodel==4.0.8", "MarkupSafe==2.0.1",
-                      "spacy", "Werkzeug==0.16.1", "python-dotenv"
+                      "spacy", "Werkzeug==0.16.1", "python-dotenv", "redis", "orjson", "pybloom-live", "gevent"
                       ],
 
     setup_requires=['spacy', 'boto3', 'nltk'],